@@ -233,54 +233,3 @@ def prepare_graph_format(G):
     d = {x: x.replace("_", "*") for x in list(G.nodes)}
     H = nx.relabel_nodes(G, d)
     return H
-
-
-############### Graph Algo Utilities ###############
-
-def semantic_sim(n1, n2, similarity_df, semantic_threshold):
-    if similarity_df is not None:
-        sim = max(similarity_df[n1][n2], similarity_df[n2][n1])
-        if sim < semantic_threshold:
-            return False
-    return True
-
-def a_valid_pair(node1, node2, similarity_df, summary_dag, semantic_threshold):
-    if not check_semantic_for_cluster_nodes(node1, node2,similarity_df, semantic_threshold):
-        return False
-    G = summary_dag.copy()
-    if summary_dag.has_edge(node1,node2):
-        G.remove_edge(node1, node2)
-
-    elif summary_dag.has_edge(node2,node1):
-        G.remove_edge(node2, node1)
-
-    if nx.has_path(G, node1, node2):
-        length =  nx.shortest_path_length(G, node1, node2)
-        if length >= 2:
-        # paths = nx.all_simple_paths(summary_dag, node1, node2)
-        # path_exists = any(len(path) >= 3 for path in paths)
-        # if path_exists:
-            return False
-    elif nx.has_path(G, node2, node1):
-        length = nx.shortest_path_length(G, node2, node1)
-        if length >= 2:
-            # #and nx.shortest_path_length(dag, node1, node2) >= 2:
-            # paths = nx.all_simple_paths(summary_dag, node2, node1)
-            # path_exists = any(len(path) >= 3 for path in paths)
-            # if path_exists:
-                return False
-    return True
-
-def check_semantic_for_cluster_nodes(node1, node2, similarity_df, semantic_threshold):
-    nodes1 = node1.split('_')
-    nodes2 = node2.split('_')
-    # print("check valid pair: ", nodes1,nodes2)
-    # print(similarity_df)
-    if similarity_df is None:
-        return True
-    for n1 in nodes1:
-        for n2 in nodes2:
-            sim = max(similarity_df[n1][n2], similarity_df[n2][n1])
-            if sim < semantic_threshold:
-                return False
-    return True
\ No newline at end of file
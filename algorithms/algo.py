@@ -1,83 +1,150 @@
 from dowhy import CausalModel
 import causallearn.utils.GraphUtils as GU
 from causallearn.search.ConstraintBased import PC
-import math
 import networkx as nx
 import itertools
+import heapq
 import random
+import numpy as np
 import pandas as pd
 import Utils
 from utils import graph_utils
-import itertools
 
-def is_special_pair(graph, node1, node2):
+# The pair heap is compacted once it holds this many entries per live pair
+HEAP_COMPACT_FACTOR = 4
+
+def is_special_pair(succ, pred, node1, node2):
     # Check if there is an edge between node1 and node2
-    if graph.has_edge(node1, node2):
+    if node2 in succ[node1]:
+        out1, in1 = len(succ[node1]), len(pred[node1])
+        out2, in2 = len(succ[node2]), len(pred[node2])
         # Check if node1 has no outgoing edges and node2 has one incoming and one outgoing edge
-        if graph.out_degree(node1) == 0 and graph.in_degree(node2) == 1 and graph.out_degree(node2) == 1:
+        if out1 == 0 and in2 == 1 and out2 == 1:
             return True
-        if graph.out_degree(node2) == 0 and graph.in_degree(node1) == 1 and graph.out_degree(node1) == 1:
+        if out2 == 0 and in1 == 1 and out1 == 1:
             return True
-        if graph.in_degree(node1) == 0 and graph.in_degree(node2) == 1 and graph.out_degree(node2) == 1:
+        if in1 == 0 and in2 == 1 and out2 == 1:
             return True
-        if graph.in_degree(node2) == 0 and graph.in_degree(node1) == 1 and graph.out_degree(node1) == 1:
+        if in2 == 0 and in1 == 1 and out1 == 1:
             return True
     return False
 
-def low_cost_merges(dag, similarity_df, not_valid, semantic_threshold):
-    nodes = dag.nodes()
-    to_merge = []
-    node_pairs = sorted(list(itertools.combinations(sorted(nodes), 2)))
-    for pair in node_pairs:
-        n1 = pair[0]
-        n2 = pair[1]
-        if not Utils.a_valid_pair(n1, n2, similarity_df, dag, semantic_threshold):
-            not_valid.add(pair)
-            continue
-        if not n1 == n2:
-            if '_' in n1 or '_' in n2:
+def low_cost_merges(succ, pred, label, size, atoms, similar, visited, not_valid, k):
+    """
+    Merges special and zero-cost pairs of original nodes in rounds. Every round
+    collects all such pairs and contracts each connected component of them in
+    one go, as long as the whole cluster is valid and contracting it does not
+    take the graph below k nodes. Other components fall back to merging disjoint
+    pairs one by one. Rounds repeat until one makes no merge or the graph is
+    down to k nodes.
+    """
+    while len(succ) > k:
+        low_cost = nx.Graph()
+        node_pairs = itertools.combinations(sorted(succ, key=label.__getitem__), 2)
+        for pair in node_pairs:
+            if pair in not_valid:
+                continue
+            n1 = pair[0]
+            n2 = pair[1]
+            if size[n1] > 1 or size[n2] > 1:
+                continue
+            if not (is_special_pair(succ, pred, n1, n2) or zero_cost(succ, pred, n1, n2)):
                 continue
-            if Utils.semantic_sim(n1, n2, similarity_df, semantic_threshold):
-                if is_special_pair(dag, n1, n2):
-                    to_merge.append((n1, n2))
-                elif zero_cost(dag, n1, n2):
-                    to_merge.append((n1, n2))
-
-    G = dag.copy()
-    for pair in to_merge:
-        node1 = pair[0]
-        node2 = pair[1]
-        if node1 in G.nodes and node2 in G.nodes:
-            G = nx.contracted_nodes(G, node1, node2, self_loops=False)
-            new_node_name = node1 + '_' + node2
-            G = nx.relabel_nodes(G, {node1: str(new_node_name), node2: str(new_node_name)})
-
-    return G, not_valid
-
-def zero_cost(G, n1, n2):
-    if G.has_edge(n1, n2) or G.has_edge(n2,n1):
-        parents1 = set(G.predecessors(n1))
-        if n2 in parents1:
-            parents1.remove(n2)
-        parents2 = set(G.predecessors(n2))
-        if n1 in parents2:
-            parents2.remove(n1)
-
-        children1 = set(G.successors(n1))
-        if n2 in children1:
-            children1.remove(n2)
-        children2 = set(G.successors(n2))
-        if n1 in children2:
-            children2.remove(n1)
+            # the reachability search only runs on the few candidate pairs
+            if not a_valid_pair(n1, n2, succ, visited, similar):
+                not_valid.add(pair)
+                continue
+            low_cost.add_edge(n1, n2)
+
+        if low_cost.number_of_edges() == 0:
+            return
+        for component in list(nx.connected_components(low_cost)):
+            if len(succ) <= k:
+                return
+            cluster = sorted(component, key=label.__getitem__)
+            if len(succ) - (len(cluster) - 1) >= k and a_valid_cluster(cluster, succ, visited, similar):
+                node = cluster[0]
+                for other in cluster[1:]:
+                    node = merge_nodes(succ, pred, label, size, atoms, similar, node, other)
+                continue
+
+            # fall back to merging disjoint pairs of the component one by one
+            merged = set()
+            pairs = sorted(ordered_pair(*edge, label) for edge in low_cost.subgraph(component).edges)
+            for pair in pairs:
+                if len(succ) <= k:
+                    return
+                if pair[0] in merged or pair[1] in merged:
+                    continue
+                if a_valid_pair(*pair, succ, visited, similar):
+                    merged.update(pair)
+                    merge_nodes(succ, pred, label, size, atoms, similar, *pair)
+
+def zero_cost(succ, pred, n1, n2):
+    succ1, pred1 = succ[n1], pred[n1]
+    succ2, pred2 = succ[n2], pred[n2]
+    if n2 in succ1 or n1 in succ2:
+        parents1 = pred1 - {n2}
+        parents2 = pred2 - {n1}
+        children1 = succ1 - {n2}
+        children2 = succ2 - {n1}
         return parents1 == parents2 and children1 == children2
     else:
-        parents1 = set(G.predecessors(n1))
-        parents2 = set(G.predecessors(n2))
-        children1 = set(G.successors(n1))
-        children2 = set(G.successors(n2))
-        return parents1 == parents2 and children1 == children2
+        return pred1 == pred2 and succ1 == succ2
+
+def to_adjacency_sets(dag):
+    """
+    Converts a NetworkX DAG into successor/predecessor sets keyed by integer
+    node ids, plus the list of node labels indexed by id.
+    """
+    label = list(dag.nodes)
+    idx = {n: i for i, n in enumerate(label)}
+    succ = {i: {idx[s] for s in dag.successors(n)} for i, n in enumerate(label)}
+    pred = {i: {idx[p] for p in dag.predecessors(n)} for i, n in enumerate(label)}
+    return succ, pred, label
 
+def to_summary_dag(dag, succ, label, atoms):
+    """
+    Builds the summary NetworkX DAG from the adjacency sets, carrying over the
+    attributes of the first original node (and edge) of every cluster.
+    """
+    G = nx.DiGraph()
+    for node in succ:
+        G.add_node(label[node], **dag.nodes[label[atoms[node][0]]])
+    for node, children in succ.items():
+        for child in children:
+            edge_data = dag.get_edge_data(label[atoms[node][0]], label[atoms[child][0]]) or {}
+            G.add_edge(label[node], label[child], **edge_data)
+    return G
 
+def merge_nodes(succ, pred, label, size, atoms, similar, node1, node2):
+    """
+    Contracts node1 and node2 into a new node (without self loops) and returns
+    its id. Only the sets of the two nodes and of their neighbours are updated.
+    """
+    new_node = len(label)
+    label.append(label[node1] + '_' + label[node2])
+    size.append(size[node1] + size[node2])
+    atoms.append(atoms[node1] + atoms[node2])
+    if similar is not None:
+        # a cluster is similar to a node iff both of its halves are
+        similar[new_node] = similar[node1] & similar[node2]
+        similar[:, new_node] = similar[new_node]
+
+    parents = (pred.pop(node1) | pred.pop(node2)) - {node1, node2}
+    children = (succ.pop(node1) | succ.pop(node2)) - {node1, node2}
+    for p in parents:
+        succ[p].difference_update((node1, node2))
+        succ[p].add(new_node)
+    for c in children:
+        pred[c].difference_update((node1, node2))
+        pred[c].add(new_node)
+    succ[new_node] = children
+    pred[new_node] = parents
+    return new_node
+
+def ordered_pair(node1, node2, label):
+    return (node1, node2) if label[node1] < label[node2] else (node2, node1)
 
 def CaGreS(dag, k, similarity_df, semantic_threshold):
     """
@@ -92,122 +159,202 @@ def CaGreS(dag, k, similarity_df, semantic_threshold):
     """
     if len(dag.nodes) <= k:
         return dag
+    succ, pred, label = to_adjacency_sets(dag)
+    size = [1] * len(label)
+    atoms = [(i,) for i in range(len(label))]
+    similar = None
+    if similarity_df is not None:
+        similar = to_similar_pairs(similarity_df, label, semantic_threshold)
+    # one visited bitmap for every cycle check, covering the ids of all
+    # nodes the n - 1 possible merges can create
+    visited = bytearray(2 * len(label) - 1)
     not_valid = set()
-    G, not_valid = low_cost_merges(dag, similarity_df, not_valid, semantic_threshold)
+    low_cost_merges(succ, pred, label, size, atoms, similar, visited, not_valid, k)
 
-    cost_scores = {}
-    while len(G.nodes) > k:
-        G, not_valid, cost_scores = fast_merge_pair(G, dag, similarity_df,
-                                                     not_valid, cost_scores,
-                                                     semantic_threshold)
+    # Costs only change for pairs touching a merged node or one of its
+    # neighbours, so keep them in a heap and lazily drop stale entries.
+    version = dict.fromkeys(succ, 0)
+    cost_heap = build_cost_heap(succ, pred, label, size, version,
+                                similar, not_valid)
+
+    while len(succ) > k:
+        merged = heap_merge_pair(succ, pred, label, size, atoms, cost_heap, version,
+                                 similar, visited, not_valid)
         
         # Fallback, could not summarize the DAG with given constraints
-        if not G:
-            break
-    return G
-
-def fast_merge_pair(G, dag, similarity_df, not_valid, cost_scores, semantic_threshold, verbos = False):
-    node_pairs = sorted(list(itertools.combinations(sorted(G.nodes()), 2)))
-    min_cost   = math.inf
-    max_pair   = []
+        if merged is None:
+            return None
+    return to_summary_dag(dag, succ, label, atoms)
 
-    for pair in node_pairs:
-        node1 = pair[0]
-        node2 = pair[1]
+def build_cost_heap(succ, pred, label, size, version, similar, not_valid):
+    """
+    Scores every pair once and heapifies the result.
+    """
+    cost_heap = []
+    for pair in itertools.combinations(sorted(succ, key=label.__getitem__), 2):
         if pair in not_valid:
             continue
-        valid = Utils.a_valid_pair(node1,node2, similarity_df, G, semantic_threshold)
-        if valid == False:
+        cost = candidate_cost(*pair, succ, pred, size, similar)
+        if cost is None:
             not_valid.add(pair)
         else:
-            if pair in cost_scores:
-                cost = cost_scores[pair]
-            else:
-                cost = get_cost(node1,node2,G)
-                cost_scores[pair] = cost
-            if verbos:
-                print(pair,cost)
-            if cost < min_cost:
-                min_cost = cost
-                max_pair = pair
-            elif cost == min_cost:
-                if random.choice([True, False]):
-                    min_cost = cost
-                    max_pair = pair
-    if len(max_pair) == 0:
-        print("could not find a pair to merge, merging a random valid pair")
-        for pair in node_pairs:
-            if pair in not_valid:
+            cost_heap.append((cost, random.random(), pair, version[pair[0]], version[pair[1]]))
+    heapq.heapify(cost_heap)
+    return cost_heap
+
+def push_pair_cost(cost_heap, succ, pred, size, pair, version, similar, not_valid):
+    if pair in not_valid:
+        return
+    node1, node2 = pair
+    cost = candidate_cost(node1, node2, succ, pred, size, similar)
+    if cost is None:
+        not_valid.add(pair)
+        return
+    # one random key per entry, so the first valid pair popped among those of
+    # equal cost is a uniform pick, with no extra draws per comparison
+    heapq.heappush(cost_heap, (cost, random.random(), pair, version[node1], version[node2]))
+
+def heap_merge_pair(succ, pred, label, size, atoms, cost_heap, version, similar, visited, not_valid):
+    while cost_heap:
+        cost, _, pair, version1, version2 = heapq.heappop(cost_heap)
+        node1, node2 = pair
+        if version.get(node1) != version1 or version.get(node2) != version2:
+            continue
+        # only the cheapest pair is checked for cycles: a zero-cost pair has an
+        # edge between the nodes and otherwise the same parents and children,
+        # so it can never close one
+        if cost > 0 and _creates_cycle(succ, pair, visited):
+            not_valid.add(pair)
+            continue
+        break
+    else:
+        print("could not find a pair to merge")
+        return None
+
+    # the parents/children of every neighbour change, so their costs are stale
+    neighbours = pred[node1] | succ[node1] | pred[node2] | succ[node2]
+    neighbours -= {node1, node2}
+
+    #print("choose to merge: ", label[node1], label[node2])
+    new_node = merge_nodes(succ, pred, label, size, atoms, similar, node1, node2)
+
+    del version[node1], version[node2]
+    version[new_node] = 0
+    for n in neighbours:
+        version[n] += 1
+
+    pushed = set()
+    for n in [new_node, *neighbours]:
+        for other in succ:
+            if other == n:
                 continue
-            if Utils.a_valid_pair(*pair, similarity_df, dag):
-                max_pair = pair
-            
-        # Fallback
-        if len(max_pair) == 0:
-            return None, not_valid, cost_scores
-    node1 = max_pair[0]
-    node2 = max_pair[1]
-
-    cost_scores = update_cost_scores(cost_scores, node1, node2, G)
-    #print("choose to merge: ", node1,node2)
-    G = nx.contracted_nodes(G, node1, node2, self_loops=False)
-    new_node_name = node1 + '_' + node2
-    G = nx.relabel_nodes(G, {node1: str(new_node_name), node2: str(new_node_name)})
-
-    return G, not_valid, cost_scores
-
-def update_cost_scores(cost_scores, node1, node2, G):
-    nodes = [node1,node2]
-    nodes = nodes + list(G.predecessors(node1)) + list(G.successors(node1))
-    nodes = nodes + list(G.predecessors(node2)) + list(G.successors(node2))
-    to_remove = []
-    for k in cost_scores:
-        for n in nodes:
-            if n in k:
-                to_remove.append(k)
+            pair = ordered_pair(n, other, label)
+            if pair not in pushed:
+                pushed.add(pair)
+                push_pair_cost(cost_heap, succ, pred, size, pair, version,
+                               similar, not_valid)
+
+    # stale entries are only dropped when popped, so compact the heap before
+    # they outgrow the live pairs
+    live_pairs = len(succ) * (len(succ) - 1) // 2
+    if len(cost_heap) > HEAP_COMPACT_FACTOR * max(live_pairs, 1):
+        cost_heap[:] = [entry for entry in cost_heap
+                        if version.get(entry[2][0]) == entry[3] and version.get(entry[2][1]) == entry[4]]
+        heapq.heapify(cost_heap)
+    return new_node
+
+def _creates_cycle(succ, nodes, visited):
+    """
+    Contracting the given nodes into one creates a cycle iff a directed path
+    leaves them and comes back (for a pair: a path of length >= 2 between
+    them). Found by one DFS from their outside successors. visited is a zeroed
+    bitmap over all node ids, shared by every call; only the entries this
+    search touched are cleared again before returning.
+    """
+    for n in nodes:
+        visited[n] = 2
+    stack = []
+    for n in nodes:
+        for child in succ[n]:
+            if not visited[child]:
+                visited[child] = 1
+                stack.append(child)
+    reached = stack[:]
+    found = False
+    while stack and not found:
+        for n in succ[stack.pop()]:
+            if visited[n] == 2:
+                found = True
                 break
-    filtered_dict = {key: value for key, value in cost_scores.items() if key not in to_remove}
-    return filtered_dict
+            if not visited[n]:
+                visited[n] = 1
+                stack.append(n)
+                reached.append(n)
+    for n in reached:
+        visited[n] = 0
+    for n in nodes:
+        visited[n] = 0
+    return found
+
+def to_similar_pairs(similarity_df, label, semantic_threshold):
+    """
+    Boolean matrix indexed by node id telling whether two nodes may share a
+    cluster, i.e. max(sim[n1][n2], sim[n2][n1]) >= threshold for all of their
+    atoms. Rows for the ids of future merged nodes are filled in by merge_nodes.
+    """
+    n = len(label)
+    mat = pd.DataFrame(similarity_df).loc[label, label].to_numpy(dtype=float)
+    similar = np.zeros((2 * n - 1, 2 * n - 1), dtype=bool)
+    similar[:n, :n] = np.maximum(mat, mat.T) >= semantic_threshold
+    return similar
+
+def check_semantic(node1, node2, similar):
+    return similar is None or similar[node1, node2]
+
+def a_valid_pair(node1, node2, succ, visited, similar):
+    if not check_semantic(node1, node2, similar):
+        return False
+    if _creates_cycle(succ, (node1, node2), visited):
+        return False
+    return True
+
+def a_valid_cluster(nodes, succ, visited, similar):
+    for node1, node2 in itertools.combinations(nodes, 2):
+        if not check_semantic(node1, node2, similar):
+            return False
+    if _creates_cycle(succ, nodes, visited):
+        return False
+    return True
+
+def candidate_cost(node1, node2, succ, pred, size, similar):
+    """
+    Returns the cost of merging node1 and node2, or None if they are not
+    semantically similar. Whether the merge would close a cycle is only checked
+    once the pair reaches the top of the heap, in heap_merge_pair, so pairs that
+    never become the cheapest never pay for the reachability search.
+    """
+    if not check_semantic(node1, node2, similar):
+        return None
+    return get_cost(node1, node2, succ, pred, size)
 
-def get_cost(node1, node2,G):
+def get_cost(node1, node2, succ, pred, size):
+    succ1, pred1, size1 = succ[node1], pred[node1], size[node1]
+    succ2, pred2, size2 = succ[node2], pred[node2], size[node2]
     cost = 0
-    nodes1 = node1.split('_')
-    nodes2 = node2.split('_')
     #edges among the new cluster
-    if not G.has_edge(node1, node2):
-        cost = cost + len(nodes1)*len(nodes2)
-
-    #edges to parents and children
-    parents1 = set(G.predecessors(node1))
-    parents2 = set(G.predecessors(node2))
-
-    #unique parents of node1
-    if node2 in parents1:
-        parents1.remove(node2)
-    parents1 = parents1 - parents2#[p for p in parents1 if not p in parents2]
-    cost = cost + len(parents1)*len(nodes2)
-
-    #parents1 = list(G.predecessors(node1))
-    # unique parents of node2
-    if node1 in parents2:
-        parents2.remove(node1)
-    parents2 = parents2-parents1#[p for p in parents2 if not p in parents1]
-    cost = cost + len(parents2) * len(nodes1)
-
-    children1 = set(G.successors(node1))
-    children2 = set(G.successors(node2))
-    # unique children of node1
-    if node2 in children1:
-        children1.remove(node2)
-    children1 = children1 - children2#[p for p in children1 if not p in children1]
-    cost = cost + len(children1) * len(nodes2)
-
-    #children1 = list(G.successors(node1))
-    # unique children of node2
-    if node1 in children2:
-        children2.remove(node1)
-    children2 = children2 - children1#[p for p in children2 if not p in children1]
-    cost = cost + len(children2) * len(nodes1)
+    if node2 not in succ1:
+        cost = cost + size1*size2
+
+    #edges to parents and children: a parent (child) of only one of the nodes
+    #gets connected to every atom of the other one. Neither node is in its own
+    #sets, so the shared count needs no adjustment for the pair itself.
+    shared_parents = len(pred1 & pred2)
+    cost = cost + (len(pred1) - (node2 in pred1) - shared_parents) * size2
+    cost = cost + (len(pred2) - (node1 in pred2) - shared_parents) * size1
+
+    shared_children = len(succ1 & succ2)
+    cost = cost + (len(succ1) - (node2 in succ1) - shared_children) * size2
+    cost = cost + (len(succ2) - (node1 in succ2) - shared_children) * size1
 
     return cost
 
@@ -257,14 +404,25 @@ def estimate_binary_treatment_effect(df, treatment_column, logic_condition, outc
     df[treatment_column] = original_values
     return causal_estimate_reg, causal_estimate_reg.test_stat_significance()['p_value']
 
-def get_grounded_dag(summary_dag):
-    nodes = list(nx.topological_sort(summary_dag))
+def get_grounded_dag(summary_dag, original_dag=None):
+    """
+    Splits every cluster of the summary DAG back into its atoms. Atoms of a
+    cluster are connected following the topological order of original_dag when
+    it is given, and the order inside the cluster label otherwise.
+    """
+    if original_dag is not None:
+        nodes = list(nx.topological_sort(original_dag))
+    else:
+        nodes = list(nx.topological_sort(summary_dag))
     return get_grounded_dag_auxiliary(summary_dag, nodes)
 
 def get_grounded_dag_auxiliary(summary_dag,nodes):
     """
     Logic copied from Utils Lib.
+    Inside every cluster, each atom is connected to the atoms after it in nodes;
+    atoms missing from nodes keep their label order, after the others.
     """
+    atom_position = {atom: i for i, atom in enumerate(nodes) if ',\n' not in atom}
     G = summary_dag.copy()
     for n in summary_dag.nodes:
         if ',\n' in n:
@@ -276,21 +434,12 @@ def get_grounded_dag_auxiliary(summary_dag,nodes):
             children = list(G.successors(node_to_split))
 
             # Add edges between new nodes and parents/children
-            for parent in parents:
-                for new_node in new_nodes:
-                    G.add_edge(parent, new_node)
-
-            for child in children:
-                for new_node in new_nodes:
-                    G.add_edge(new_node, child)
-
-            for new_node in new_nodes:
-                for node_before in nodes:
-                    if node_before not in n:
-                        continue
-                    if node_before == new_node:
-                        break  # Stop connecting nodes once we reach the target node
-                    G.add_edge(node_before, new_node)
+            G.add_edges_from(itertools.product(parents, new_nodes))
+            G.add_edges_from(itertools.product(new_nodes, children))
+
+            # Connect every atom to the atoms after it (the sort is stable)
+            atoms_sorted = sorted(new_nodes, key=lambda atom: atom_position.get(atom, len(nodes)))
+            G.add_edges_from(itertools.combinations(atoms_sorted, 2))
             # Remove the original node
             G.remove_node(node_to_split)
     #show_dag(G,'grounded_dag')
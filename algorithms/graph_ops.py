@@ -29,16 +29,14 @@ def try_add_edge(G: nx.DiGraph, n1: str, n2: str) -> bool:
         st.error(f"Node {n2} does not exist.")
         return False
 
-    # 3) Attempt to add
-    G.add_edge(n1, n2)
-
-    # 4) Check if we’re still a DAG
-    if not nx.is_directed_acyclic_graph(G):
-        # revert
-        G.remove_edge(n1, n2)
+    # 3) The new edge closes a cycle iff n1 is already reachable from n2
+    if nx.has_path(G, n2, n1):
         st.error(f"Adding edge ({n1}->{n2}) creates a cycle! Denied.")
         return False
 
+    # 4) Add it
+    G.add_edge(n1, n2)
+
     # otherwise, success
     st.success(f"Edge ({n1}->{n2}) added.")
     return True
@@ -143,7 +143,11 @@ async def sidebar_compute_causal_effects():
     graphs = [G]
     if st.session_state.summarized_dag is not None:
         summary_dag = st.session_state.summarized_dag
-        H = algo.get_grounded_dag(summary_dag)
+        # the summary labels its atoms like summarize_dag does, so order them
+        # by the original DAG under the same naming
+        original_dag = Utils.convert_ast_underscore_nodes(
+            Utils.prepare_graph_format(st.session_state.original_dag))
+        H = algo.get_grounded_dag(summary_dag, original_dag)
         H = Utils.convert_nodes_snake_to_pascal_case(H)
         graphs.append(H)
         
@@ -0,0 +1,117 @@
+import itertools
+import random
+
+import networkx as nx
+
+from utils import graph_utils  # noqa: F401  (imported first, as app.py does)
+from algorithms import algo
+
+
+def to_state(dag):
+    succ, pred, label = algo.to_adjacency_sets(dag)
+    size = [1] * len(label)
+    atoms = [(i,) for i in range(len(label))]
+    return succ, pred, label, size, atoms
+
+
+def fan_dag(width):
+    """r -> c00..c{width-1} -> z"""
+    dag = nx.DiGraph()
+    for i in range(width):
+        dag.add_edge("r", f"c{i:02d}")
+        dag.add_edge(f"c{i:02d}", "z")
+    return dag
+
+
+def test_low_cost_merges_stops_at_k():
+    succ, pred, label, size, atoms = to_state(fan_dag(20))
+    algo.low_cost_merges(succ, pred, label, size, atoms, None, bytearray(2 * len(label) - 1),
+                         set(), 15)
+    assert len(succ) == 15
+
+
+def test_cagres_keeps_k_nodes_on_zero_cost_component():
+    summary = algo.CaGreS(fan_dag(20), 15, None, None)
+    assert summary is not None
+    assert summary.number_of_nodes() == 15
+    assert nx.is_directed_acyclic_graph(summary)
+
+
+def test_low_cost_merges_contracts_whole_component():
+    succ, pred, label, size, atoms = to_state(fan_dag(5))
+    algo.low_cost_merges(succ, pred, label, size, atoms, None, bytearray(2 * len(label) - 1),
+                         set(), 1)
+    assert sorted(sorted(label[a] for a in atoms[node]) for node in succ) == [
+        ["c00", "c01", "c02", "c03", "c04", "z"], ["r"]]
+
+
+def test_low_cost_merges_merges_pairs_exposed_by_earlier_rounds():
+    dag = nx.DiGraph([("a", "b"), ("b", "c1"), ("b", "c2")])
+    succ, pred, label, size, atoms = to_state(dag)
+    algo.low_cost_merges(succ, pred, label, size, atoms, None, bytearray(2 * len(label) - 1),
+                         set(), 1)
+    # the first round merges the zero-cost siblings c1 and c2; only then is
+    # a -> b a special pair, which the second round merges
+    assert sorted(sorted(label[a] for a in atoms[node]) for node in succ) == [
+        ["a", "b"], ["c1", "c2"]]
+    summary = algo.to_summary_dag(dag, succ, label, atoms)
+    assert nx.is_directed_acyclic_graph(summary)
+
+
+def reference_cost(node1, node2, succ, pred, size):
+    """Edges added by merging node1 and node2, counted with set differences."""
+    parents1, parents2 = pred[node1] - {node2}, pred[node2] - {node1}
+    children1, children2 = succ[node1] - {node2}, succ[node2] - {node1}
+    cost = 0 if node2 in succ[node1] else size[node1] * size[node2]
+    cost += len(parents1 - parents2) * size[node2] + len(parents2 - parents1) * size[node1]
+    cost += len(children1 - children2) * size[node2] + len(children2 - children1) * size[node1]
+    return cost
+
+
+def test_get_cost_ignores_shared_neighbours_of_node2():
+    dag = nx.DiGraph([("p", "a"), ("p", "b"), ("a", "b"), ("a", "c"), ("b", "c"), ("q", "b")])
+    succ, pred, label, size, atoms = to_state(dag)
+    a, b = label.index("a"), label.index("b")
+    size[a], size[b] = 2, 3
+    # only q, a parent of b alone, needs new edges to the atoms of a
+    assert algo.get_cost(a, b, succ, pred, size) == 2
+
+
+def test_get_cost_matches_set_difference_reference():
+    rng = random.Random(0)
+    for seed in range(50):
+        dag = nx.gnp_random_graph(12, 0.3, seed=seed, directed=True)
+        dag = nx.DiGraph([(u, v) for u, v in dag.edges if u < v])
+        dag.add_nodes_from(range(12))
+        succ, pred, label, size, atoms = to_state(dag)
+        size = [rng.randint(1, 4) for _ in label]
+        for node1, node2 in itertools.permutations(succ, 2):
+            assert algo.get_cost(node1, node2, succ, pred, size) == \
+                reference_cost(node1, node2, succ, pred, size)
+
+
+def test_get_grounded_dag_restores_edges_inside_clusters():
+    dag = nx.DiGraph([("a", "b"), ("b", "c"), ("a", "c"), ("c", "d"), ("x", "b")])
+    # b and c are joined in label order, which is not the order of the DAG
+    summary = nx.DiGraph([("a", "c,\nb"), ("x", "c,\nb"), ("c,\nb", "d")])
+    grounded = algo.get_grounded_dag(summary, dag)
+    assert set(grounded.nodes) == set(dag.nodes)
+    assert grounded.has_edge("b", "c") and not grounded.has_edge("c", "b")
+    assert all(grounded.has_edge(*edge) for edge in dag.edges)
+    assert nx.is_directed_acyclic_graph(grounded)
+
+
+def test_get_grounded_dag_falls_back_to_label_order():
+    summary = nx.DiGraph([("a", "c,\nb")])
+    grounded = algo.get_grounded_dag(summary)
+    assert sorted(grounded.edges) == [("a", "b"), ("a", "c"), ("c", "b")]
+
+
+def test_creates_cycle_clears_the_shared_visited_bitmap():
+    dag = nx.DiGraph([("a", "b"), ("b", "c"), ("a", "c"), ("c", "d")])
+    succ, pred, label, size, atoms = to_state(dag)
+    visited = bytearray(2 * len(label) - 1)
+    a, b, c, d = (label.index(n) for n in "abcd")
+    for pair, creates_cycle in [((a, c), True), ((a, b), False), ((b, d), True), ((c, d), False)]:
+        assert algo._creates_cycle(succ, pair, visited) == creates_cycle
+        assert not any(visited)
@@ -60,12 +60,13 @@ def visualize_dag_with_pyvis(G: nx.DiGraph,
     """
     Visualize a NetworkX DiGraph using PyVis, filling the column width (width="100%").
     We'll keep a fixed height for the net, but let it stretch horizontally.
+    PyVis may add attributes (e.g. 'size') to G's node data, so pass a throwaway
+    graph such as the one returned by to_pyvis_compatible().
     """
     try:
         logger.debug("Initializing PyVis network (directed).")
         net = Network(height=height, width=width, directed=True, notebook=False)
-        H = G.copy()
-        net.from_nx(H)
+        net.from_nx(G)
 
         # Style nodes
         for node in net.nodes: